@@ -27,6 +27,8 @@ from xmhw.identify import (
     get_calendar,
     join_gaps,
     join_events,
+    clim_gather,
+    unstack_cells,
 )
 from xmhw_fixtures import *
 from xmhw.exception import XmhwException
@@ -35,7 +37,6 @@ import xarray.testing as xrtest
 import pandas.testing as pdtest
 
 
-@pytest.mark.xfail
 def test_add_doy(oisst_ts, oisst_doy, days5_doy, mon_doy):
     doy = add_doy(oisst_ts, tdim="time").doy.values
     nptest.assert_array_equal(doy, oisst_doy)
@@ -47,6 +48,12 @@ def test_add_doy(oisst_ts, oisst_doy, days5_doy, mon_doy):
     sstmon, doysmon = mon_doy
     doy = add_doy(sstmon, tdim="time", keep_tstep=True).doy.values
     nptest.assert_array_equal(doy, doysmon)
+    # test same dates with different calendars one after the other
+    for cal in ["noleap", "all_leap", "standard"]:
+        time = xr.cftime_range("2001-01-30", periods=30, calendar=cal)
+        ts = xr.DataArray(np.ones(30), dims=["time"], coords={"time": time})
+        doy = add_doy(ts, tdim="time").doy.values
+        nptest.assert_array_equal(doy, np.arange(30, 60))
 
 
 def test_feb29(oisst_ts):
@@ -77,7 +84,6 @@ def test_runavg():
         runavg(a, 2).compute()
 
 
-@pytest.mark.xfail
 def test_window_roll(oisst_ts, tstack):
     ts = oisst_ts.sel(
         time=slice("2003-01-01", "2003-01-03"), lat=-42.625, lon=148.125
@@ -111,15 +117,21 @@ def test_mhw_filter(filter_data):
     # These tests only check on 1 D to make sure it work on 2 d add extra tests
     bthresh, idxarr, st, end, evs, st2, end2, evs2 = filter_data
     # test with joinGaps=False
-    df = mhw_filter(bthresh, idxarr, 5, False)
+    df = mhw_filter(bthresh, 5, False)
     pdtest.assert_series_equal(df.start, st)
     pdtest.assert_series_equal(df.end, end)
     pdtest.assert_series_equal(df.events, evs)
     # test with default joinGaps True and maxGaps=3, join 2nd and 3rd events
-    df2 = mhw_filter(bthresh, idxarr, 5, True, 3)
+    df2 = mhw_filter(bthresh, 5, True, 3)
     pdtest.assert_series_equal(df2.start, st2)
     pdtest.assert_series_equal(df2.end, end2)
     pdtest.assert_series_equal(df2.events, evs2)
+    # test event starting on first day of timeseries is kept whole
+    bthresh0 = bthresh.copy()
+    bthresh0.iloc[0] = True
+    df3 = mhw_filter(bthresh0, 5, True, 3)
+    assert df3.start.iloc[5] == 0
+    assert df3.events.iloc[0] == 0
 
 
 def test_join_events(join_data):
@@ -155,6 +167,37 @@ def test_land_check(oisst_ts, clim_oisst, landgrid):
         land_check(oisst_ts.sel(lat=slice(-41, -41.5)))
 
 
+def test_clim_gather(oisst_ts):
+    ts = add_doy(oisst_ts.isel(lat=5, lon=3), tdim="time")
+    doy = np.arange(1, 367)
+    th = xr.DataArray(doy * 1.0, dims=["doy"], coords={"doy": doy})
+    thresh, seas = clim_gather(ts, th, th * 2)
+    nptest.assert_array_equal(thresh.values, ts.doy.values)
+    nptest.assert_array_equal(seas.values, ts.doy.values * 2)
+    # climatology without 29 Feb
+    th = th.where(th.doy != 60, drop=True)
+    with pytest.raises(XmhwException):
+        clim_gather(ts, th, th)
+
+
+def test_unstack_cells():
+    dates = xr.cftime_range("2001-01-01", periods=3, calendar="noleap")
+    ds = xr.Dataset(
+        {"b": ("cell", [True, False, True]), "f": ("cell", [1.0, 2.0, 3.0]),
+         "t": ("cell", dates.values)},
+        coords={"lat": ("cell", [1, 1, 2]), "lon": ("cell", [1, 2, 1])},
+    )
+    out = unstack_cells(ds, ["lat", "lon"])
+    # missing grid point is NaN and dtypes are promoted as by unstack()
+    xrtest.assert_identical(
+        out, ds.set_index(cell=["lat", "lon"]).unstack("cell")
+    )
+    assert out.b.dtype == object
+    assert out.t.dtype == object
+    assert out.t.values[0, 1] == dates[1]
+    assert np.isnan(out.f.values[1, 1])
+
+
 def test_define_events(define_data, mhw_data, inter_data):
     # test define events return two datasets if intermediate is True
     ts, th, se, idxarr = define_data
@@ -164,7 +207,6 @@ def test_define_events(define_data, mhw_data, inter_data):
         ts,
         th,
         se,
-        idxarr,
         5,
         True,
         2,
@@ -179,7 +221,6 @@ def test_define_events(define_data, mhw_data, inter_data):
         ts,
         th,
         se,
-        idxarr,
         5,
         True,
         2,
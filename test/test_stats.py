@@ -24,6 +24,8 @@ from xmhw.stats import (
     check_coordinates,
 )
 from xmhw.identify import land_check
+import xmhw.xmhw
+from xmhw.xmhw import threshold, detect
 from xmhw_fixtures import *
 from xmhw.exception import XmhwException
 import numpy.testing as nptest
@@ -31,8 +33,26 @@ import xarray.testing as xrtest
 import pandas.testing as pdtest
 
 
-def test_block_average():
-    pass
+def test_block_average(oisst_ts, monkeypatch):
+    # use blocks of cells in threshold and detect for any number of CPUs
+    monkeypatch.setattr(xmhw.xmhw, "cell_chunks", lambda *a, **k: 5)
+    clim = threshold(oisst_ts)
+    mhw, inter = detect(oisst_ts, clim.thresh, clim.seas, intermediate=True)
+    block = block_average(mhw, dstime=inter)
+    assert set(block.dims) == set(["years", "lat", "lon"])
+    # cells are aggregated together, results should be the same as
+    # for the same cell passed as a single point
+    point = oisst_ts.isel(lat=5, lon=3).drop_vars(["lat", "lon"])
+    pclim = threshold(point)
+    pmhw = detect(point, pclim.thresh, pclim.seas)
+    pblock = block_average(pmhw, period=[2003, 2004])
+    cell = block.sel(lat=oisst_ts.lat[5], lon=oisst_ts.lon[3])
+    for v in pblock.data_vars:
+        nptest.assert_array_almost_equal(
+            cell[v].values, pblock[v].values, decimal=5
+        )
+    assert cell.total_days.sum() == inter.events.sel(
+        lat=oisst_ts.lat[5], lon=oisst_ts.lon[3]).notnull().sum()
 
 
 def test_cat_days():
@@ -15,13 +15,13 @@
 # limitations under the License.
 
 
+import xmhw.xmhw
 from xmhw.xmhw import threshold, detect
 from xmhw_fixtures import *
 from numpy import testing as nptest
 from xmhw.exception import XmhwException
 
 
-@pytest.mark.xfail
 def test_threshold(clim_oisst, clim_oisst_nosmooth, oisst_ts):
     # test exceptions with wrong arguments
     with pytest.raises(XmhwException):
@@ -67,7 +67,6 @@ def test_threshold(clim_oisst, clim_oisst_nosmooth, oisst_ts):
     # add test with skipna False for this set and one without nans
 
 
-@pytest.mark.xfail
 def test_detect(oisst_ts, clim_oisst):
     # detect(temp, thresh, seas, minDuration=5, joinAcrossGaps=True, maxGap=2, maxPadLength=None, coldSpells=False, tdim='time')
     # test exceptions with wrong arguments
@@ -79,3 +78,56 @@ def test_detect(oisst_ts, clim_oisst):
             minDuration=3,
             maxGap=5,
         )
+
+
+def test_block_point(oisst_ts, monkeypatch):
+    # cells with some NaNs calculated in a block of cells should give
+    # the same results as the same cell passed as a single point.
+    # Block size depends on the number of CPUs, so it is fixed to split
+    # the 12 ocean cells in blocks of 5, 5 and 2 cells
+    monkeypatch.setattr(xmhw.xmhw, "cell_chunks", lambda *a, **k: 5)
+    ts = oisst_ts.copy()
+    ts[100:110, 5, 3] = np.nan
+    ts[400:403, 2, 2] = np.nan
+    clim = threshold(ts)
+    mhw = detect(ts, clim.thresh, clim.seas)
+    for lat, lon in [(5, 3), (2, 2)]:
+        point = ts.isel(lat=lat, lon=lon).drop_vars(["lat", "lon"])
+        pclim = threshold(point)
+        pmhw = detect(point, pclim.thresh, pclim.seas)
+        cell = dict(lat=ts.lat[lat], lon=ts.lon[lon])
+        for v in ["thresh", "seas"]:
+            nptest.assert_array_almost_equal(
+                clim[v].sel(cell).values, pclim[v].values, decimal=5
+            )
+        cmhw = mhw.sel(cell).dropna(dim="events", how="all")
+        nptest.assert_array_equal(cmhw.events.values, pmhw.events.values)
+        nptest.assert_array_almost_equal(
+            cmhw.intensity_max.values, pmhw.intensity_max.values, decimal=5
+        )
+
+
+def test_detect_cftime(oisst_ts):
+    # gridded timeseries with a noleap calendar, event dates are cftime
+    # objects and land points have no events
+    ts = oisst_ts.sel(time=~((oisst_ts.time.dt.month == 2)
+                             & (oisst_ts.time.dt.day == 29)))
+    clim = threshold(ts)
+    mhw = detect(ts, clim.thresh, clim.seas)
+    time = xr.cftime_range("2003-01-01", periods=ts.sizes["time"],
+                           freq="D", calendar="noleap")
+    tsnl = ts.assign_coords(time=time.shift(12, "h"))
+    climnl = threshold(tsnl)
+    mhwnl = detect(tsnl, climnl.thresh, climnl.seas)
+    assert mhwnl.time_start.dtype == object
+    nptest.assert_array_almost_equal(
+        climnl.thresh.values, clim.thresh.values, decimal=5
+    )
+    nptest.assert_array_almost_equal(
+        mhwnl.intensity_max.values, mhw.intensity_max.values, decimal=5
+    )
+    mask = mhw.time_start.notnull().values
+    nptest.assert_array_equal(
+        [t.strftime("%Y-%m-%d") for t in mhwnl.time_start.values[mask]],
+        np.datetime_as_string(mhw.time_start.values[mask], unit="D"),
+    )
@@ -17,6 +17,7 @@
 
 
 import numpy as np
+import pandas as pd
 
 
 def mhw_df(df):
@@ -34,38 +35,33 @@ def mhw_df(df):
         severity and relative norms
     """
 
-    # get temp, climatologies values for events only
     ismhw = df.events.notna()
-    mhw_temp = df.ts.where(ismhw)
-    mhw_seas = df.seas.where(ismhw)
-    mhw_thresh = df.thresh.where(ismhw)
 
     # difference ts and seas, needed to calculate onset and decline rates
     anom = df.ts - df.seas
     df["anom_plus"] = anom.shift(+1)
     df["anom_minus"] = anom.shift(-1)
+    # calculate differences with climatologies along the whole series
+    # and mask them once to keep values for events only
+    t_thresh = df.ts - df.thresh
+    thresh_seas = df.thresh - df.seas
+    df["relSeas"] = anom.where(ismhw)
+    df["relThresh"] = t_thresh.where(ismhw)
+    df["relThreshNorm"] = (t_thresh / thresh_seas).where(ismhw)
+    # calculate severity
+    df["severity"] = (anom / -thresh_seas).where(ismhw)
     # Adding ts, seas, thresh to dataframe so intermediate results and
     # climatologies can be saved together
-    df["time"] = df.index
-    df["seas"] = mhw_seas
-    df["thresh"] = mhw_thresh
-    t_seas = mhw_temp - mhw_seas
-    t_thresh = mhw_temp - mhw_thresh
-    thresh_seas = mhw_thresh - mhw_seas
-    df["relSeas"] = t_seas
-    df["relThresh"] = t_thresh
-    df["relThreshNorm"] = t_thresh / thresh_seas
-    # calculate severity
-    df["severity"] = t_seas / -(thresh_seas)
+    df["seas"] = df.seas.where(ismhw)
+    df["thresh"] = df.thresh.where(ismhw)
     # calculate categories
-    df["severity"] = t_seas / -(thresh_seas)
     df["cats"] = np.floor(1.0 + df.relThreshNorm)
     df["duration_moderate"] = df.cats == 1.0
     df["duration_strong"] = df.cats == 2.0
     df["duration_severe"] = df.cats == 3.0
     df["duration_extreme"] = df.cats >= 4.0
     # also needed to calculate onset decline rates
-    df["mabs"] = mhw_temp
+    df["mabs"] = df.ts.where(ismhw)
     return df
 
 
@@ -95,14 +91,21 @@ def mhw_features(dftime, last, tdim, dims):
 
 
 def agg_df(df, tdim, dims):
-    """Groupby events and apply different functions depending on attribute.
+    """Aggregate MHW properties by event in a single pass.
+
+    Events are contiguous blocks along the time axis, so instead of a
+    groupby each property is calculated with segmented reductions
+    (ufunc.reduceat) over the rows belonging to events. NaNs are skipped
+    as in the equivalent pandas aggregations.
 
     Parameters
     ----------
-    dftime: pandas Dataframe
+    df: pandas Dataframe
         Includes MHW characteristics along time index
-    last: int
-        Index of last element of series to calculate rates
+    tdim: str
+        Name of time dimension
+    dims: list(str)
+        Dimensions used to stack the cell
 
     Returns
     -------
@@ -110,51 +113,117 @@ def agg_df(df, tdim, dims):
         Includes most MHW properties by events
     """
 
-    # using an aggregation dictionary to avoid apply.
-    dfout = df.groupby("events", group_keys=True).agg(
-        event=("events", "first"),
-        index_start=("start", "first"),
-        index_end=("end", "first"),
-        time_start=(tdim, "first"),
-        time_end=(tdim, "last"),
-        relS_imax=("relSeas", np.argmax),
-        # time as dataframe index, instead
-        # of the timeseries index
-        time_peak=("relSeas", "idxmax"),
-        # the following are needed for onset_decline
-        # anom_plus is (sst -seas) shifted 1 day ahead
-        # anom_minus is (sst -seas) shifted 1 day back
-        relS_first=("relSeas", "first"),
-        relS_last=("relSeas", "last"),
-        anom_first=("anom_plus", "first"),
-        anom_last=("anom_minus", "last"),
-        # intensity_max can be used as relSeas(index_peak)
-        # in onset_decline
-        intensity_max=("relSeas", "max"),
-        intensity_mean=("relSeas", "mean"),
-        intensity_cumulative=("relSeas", "sum"),
-        severity_max=("severity", "max"),
-        severity_mean=("severity", "mean"),
-        severity_cumulative=("severity", "sum"),
-        severity_var=("severity", "var"),
-        relS_var=("relSeas", "var"),
-        relT_var=("relThresh", "var"),
-        intensity_mean_relThresh=("relThresh", "mean"),
-        intensity_cumulative_relThresh=("relThresh", "sum"),
-        intensity_mean_abs=("mabs", "mean"),
-        mabs_var=("mabs", "var"),
-        intensity_cumulative_abs=("mabs", "sum"),
-        cats_max=("cats", "max"),
-        duration_moderate=("duration_moderate", "sum"),
-        duration_strong=("duration_strong", "sum"),
-        duration_severe=("duration_severe", "sum"),
-        duration_extreme=("duration_extreme", "sum"),
-    ) 
+    # select only rows which are part of an event and find where
+    # each event starts
+    events = df["events"].values
+    rows = np.flatnonzero(~np.isnan(events))
+    events = events[rows]
+    newev = np.ones(len(events), dtype=bool)
+    newev[1:] = events[1:] != events[:-1]
+    offsets = np.flatnonzero(newev)
+    evlen = np.diff(np.append(offsets, len(events)))
+    pos = np.arange(len(events))
+
+    def column(name):
+        return df[name].values[rows]
+
+    def count(x):
+        return np.add.reduceat(~np.isnan(x), offsets)
+
+    # sums are accumulated in float64 and cast back to input dtype
+    def total(x, dtype=None):
+        out = np.add.reduceat(np.where(np.isnan(x), 0.0, x), offsets,
+                              dtype=np.float64)
+        return out.astype(dtype or x.dtype)
+
+    def mean(x, dtype=None):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out = total(x, np.float64) / count(x)
+        return out.astype(dtype or x.dtype)
+
+    def var(x):
+        anom = x - np.repeat(mean(x, np.float64), evlen)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out = total(anom * anom) / (count(x) - 1)
+        return out.astype(x.dtype)
+
+    def vmax(x):
+        return np.fmax.reduceat(x, offsets)
+
+    def first(x):
+        # position of first/last non-NaN value in each event
+        idx = np.where(np.isnan(x), len(x), pos)
+        idx = np.minimum.reduceat(idx, offsets)
+        return np.append(x, np.nan)[idx]
+
+    def last(x):
+        idx = np.where(np.isnan(x), -1, pos)
+        idx = np.maximum.reduceat(idx, offsets)
+        return np.where(idx >= 0, x[idx], np.nan)
+
+    relSeas = column("relSeas")
+    relThresh = column("relThresh")
+    severity = column("severity")
+    mabs = column("mabs")
+    # times are taken directly from the dataframe index
+    time = df.index.values[rows]
+    # argmax returns position of maximum relative to event start
+    peak = np.where(relSeas == np.repeat(vmax(relSeas), evlen),
+                    pos, len(pos))
+    relS_imax = np.minimum.reduceat(peak, offsets) - offsets
+    dfout = pd.DataFrame(
+        {
+            "event": events[offsets],
+            "index_start": first(column("start")),
+            "index_end": first(column("end")),
+            "time_start": time[offsets],
+            "time_end": time[offsets + evlen - 1],
+            "relS_imax": relS_imax,
+            # time as dataframe index, instead
+            # of the timeseries index
+            "time_peak": time[offsets + relS_imax],
+            # the following are needed for onset_decline
+            # anom_plus is (sst -seas) shifted 1 day ahead
+            # anom_minus is (sst -seas) shifted 1 day back
+            "relS_first": first(relSeas),
+            "relS_last": last(relSeas),
+            "anom_first": first(column("anom_plus")),
+            "anom_last": last(column("anom_minus")),
+            # intensity_max can be used as relSeas(index_peak)
+            # in onset_decline
+            "intensity_max": vmax(relSeas),
+            "intensity_mean": mean(relSeas),
+            "intensity_cumulative": total(relSeas),
+            "severity_max": vmax(severity),
+            "severity_mean": mean(severity),
+            "severity_cumulative": total(severity),
+            "severity_var": var(severity),
+            "relS_var": var(relSeas),
+            "relT_var": var(relThresh),
+            "intensity_mean_relThresh": mean(relThresh),
+            "intensity_cumulative_relThresh": total(relThresh),
+            "intensity_mean_abs": mean(mabs),
+            "mabs_var": var(mabs),
+            "intensity_cumulative_abs": total(mabs),
+            "cats_max": vmax(column("cats")),
+        },
+        index=pd.Index(events[offsets], name="events"),
+    )
+    # count days falling in each category for all events in one pass
+    # categories 1-4 are Moderate, Strong, Severe and Extreme (>=4)
+    cats = column("cats")
+    incat = cats >= 1
+    code = np.repeat(np.arange(len(offsets)), evlen)[incat] * 4
+    code += np.minimum(cats[incat], 4).astype(np.int64) - 1
+    ncats = np.bincount(code, minlength=4 * len(offsets))
+    ncats = ncats.reshape(len(offsets), 4)
+    for i, cat in enumerate(["moderate", "strong", "severe", "extreme"]):
+        dfout[f"duration_{cat}"] = ncats[:, i]
     # adding dimensions used in stacked cell to recreate cell later
     # sending values to list to avoid warnings
     for d in dims:
         val = df[d].to_list()
-        dfout.loc[:,d] = val[0] 
+        dfout[d] = val[0]
     return dfout
 
 
@@ -181,8 +250,11 @@ def properties(df, relT, mabs):
     df2['index_peak'] = df.event + df.relS_imax
     df2['intensity_var'] = np.sqrt(df.relS_var)
     df2['severity_var'] = np.sqrt(df.severity_var)
-    df2['intensity_max_relThresh'] = relT[df.time_peak].values
-    df2['intensity_max_abs'] = mabs[df.time_peak].values
+    # index_peak is the position of the peak along the time axis, so
+    # peak values can be gathered directly instead of lookup by time
+    peak = df2['index_peak'].values.astype(np.int64)
+    df2['intensity_max_relThresh'] = relT.values[peak]
+    df2['intensity_max_abs'] = mabs.values[peak]
     df2['intensity_var_relThresh'] = np.sqrt(df.relT_var)
     df2['intensity_var_abs'] = np.sqrt(df.mabs_var)
     df2['category'] = np.minimum(df.cats_max, 4)
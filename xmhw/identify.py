@@ -20,6 +20,7 @@ import xarray as xr
 import numpy as np
 import pandas as pd
 import dask
+import functools
 from datetime import date
 from .exception import XmhwException
 from .features import mhw_df, mhw_features
@@ -46,6 +47,55 @@ def add_doy(ts, tdim="time", keep_tstep=False):
         Timeseries array with extra 'doy' coordinate
     """
 
+    # doy only depends on the time values, which are passed as a
+    # hashable key so the result is reused when add_doy is called again
+    # on the same time axis, i.e. by threshold and detect.
+    # cftime dates of different calendars can't be compared, so the
+    # calendar is passed before the dates and keys of different
+    # calendars differ before their dates are compared
+    t = ts[tdim]
+    if t.dtype.kind == "M":
+        calendar = None
+        times = t.values.tobytes()
+    else:
+        calendar = getattr(t.values[0], "calendar", None)
+        times = tuple(t.values)
+    doys = doy_values(calendar, t.dtype.str, keep_tstep, times)
+    doy = xr.DataArray(data=doys, dims=(tdim), coords={tdim: t})
+    # return new doy as coordinate of the "ts" input variable, if ts is
+    # a dask array match its time chunks rather than using one chunk
+    # for the whole time axis
+    if ts.chunks:
+        doy = doy.chunk({tdim: ts.chunks[ts.get_axis_num(tdim)]})
+    ts.coords["doy"] = doy
+    return ts
+
+
+@functools.lru_cache(maxsize=4)
+def doy_values(calendar, dtype, keep_tstep, times):
+    """Return 'doy' values for a time axis, see add_doy().
+
+    Results are cached, as the same time axis is usually passed first
+    to threshold and then to detect.
+
+    Parameters
+    ----------
+    calendar: str or None
+        Calendar of cftime datetime objects, None for datetime64 arrays
+    dtype: str
+        Time values dtype
+    keep_tstep: bool
+        If True base 'doy' unit on original timestep
+    times: bytes or tuple
+        Time values, as bytes for datetime64 arrays, otherwise as tuple
+        of datetime objects
+
+    Returns
+    -------
+    doys: numpy array
+        Read-only array of doy values
+    """
+
     # If keeping the timestep as unit for doy:
     # find out how many tsteps in 1 year, check all years are complete
     # assign values from 1 to number of tsteps to new coordinate for
@@ -54,10 +104,14 @@ def add_doy(ts, tdim="time", keep_tstep=False):
     # get original dayofyear
     # create filters: from 1st of March onwards and non leap years
     # add extra day if not leap year and march or later
-    t = ts[tdim]
+    if isinstance(times, bytes):
+        values = np.frombuffer(times, dtype=dtype)
+    else:
+        values = np.array(times, dtype=object)
+    t = xr.DataArray(values, dims="time", coords={"time": values})
     if keep_tstep is True:
         years = np.unique(t.dt.year.values)
-        oneyear = t.where(t.dt.year == years[1]).dropna(dim=tdim)
+        oneyear = t.where(t.dt.year == years[1]).dropna(dim="time")
         if len(t) % len(oneyear) != 0.0:
             raise XmhwException(
                 "To use original timestep as "
@@ -65,18 +119,16 @@ def add_doy(ts, tdim="time", keep_tstep=False):
                 + " complete years"
             )
         nyears = int(len(t) / len(oneyear))
-        doy_values = np.array(range(1, len(oneyear) + 1))
-        doys = np.stack([doy_values for _ in range(nyears)], axis=0)
+        steps = np.array(range(1, len(oneyear) + 1))
+        doys = np.stack([steps for _ in range(nyears)], axis=0)
         doys = doys.flatten()
-        doy = xr.DataArray(data=doys, dims=(tdim), coords={"time": t})
     else:
         doy_original = t.dt.dayofyear
         march_or_later = t.dt.month >= 3
         not_leap_year = ~t.dt.is_leap_year
-        doy = doy_original + (not_leap_year & march_or_later)
-    # rechunk and return new doy as coordinate of the "ts" input variable
-    ts.coords["doy"] = doy.chunk({tdim: -1})
-    return ts
+        doys = (doy_original + (not_leap_year & march_or_later)).values
+    doys.setflags(write=False)
+    return doys
 
 
 def get_calendar(time):
@@ -138,21 +190,19 @@ def feb29(ts, dim="doy"):
     """Calculate values for 29Feb by averaging days 28,29 Feb and 1 Mar
 
     Original code ignores values for 29 Feb, and uses only 28 Feb and
-    1 Mar values. To replicate comment/uncomment return options.
+    1 Mar values. To replicate comment/uncomment days options.
 
     Returns
     -------
         Interpolated values for Feb29
     """
-    return (
-        ts.where(ts.doy.isin([59, 60, 61]), drop=True).mean(
-            dim=dim, skipna=True).values
-    )
-    # return (ts.where(ts.doy.isin([59,61]),drop=True).mean(
-    #         dim=dim, skipna=True).values)
+    # select only the rows for the averaged days by position, rather
+    # than masking the whole array with where(drop=True)
+    days = np.flatnonzero(np.isin(ts.doy.values, [59, 60, 61]))
+    # days = np.flatnonzero(np.isin(ts.doy.values, [59, 61]))
+    return ts.isel({dim: days}).mean(dim=dim, skipna=True).values
 
 
-@dask.delayed(nout=1)
 def runavg(ts, w):
     """Performs a running average of a time series using a uniform
     window of width w.
@@ -173,16 +223,54 @@ def runavg(ts, w):
     """
     if w % 2 == 0:
         raise XmhwException("Running average window should be odd")
-    ts_avg = (
-        ts.pad(doy=(w - 1) // 2, mode="wrap")
-        .rolling(doy=w, center=True)
-        .mean()
-        .dropna(dim="doy")
-    )
+    # pad doy axis wrapping around the year, then get each window sum
+    # as the difference of two cumulative sums, so every value is added
+    # only once rather than once for each window including it.
+    # Sums are accumulated in float64 and windows with any NaN are NaN
+    axis = ts.get_axis_num("doy")
+    x = np.moveaxis(ts.values, axis, -1)
+    pad_width = [(0, 0)] * (x.ndim - 1) + [((w - 1) // 2, (w - 1) // 2)]
+    x = np.pad(x, pad_width, mode="wrap")
+    zero = np.zeros(x.shape[:-1] + (1,))
+    csum = np.concatenate(
+        [zero, np.nancumsum(x, axis=-1, dtype=np.float64)], axis=-1)
+    cnan = np.concatenate([zero, np.cumsum(np.isnan(x), axis=-1)], axis=-1)
+    avg = (csum[..., w:] - csum[..., :-w]) / w
+    avg[(cnan[..., w:] - cnan[..., :-w]) > 0] = np.nan
+    avg = avg.astype(np.result_type(ts.dtype, np.float32))
+    ts_avg = ts.copy(data=np.moveaxis(avg, -1, axis))
     return ts_avg
 
 
-def window_roll(ts, w, tdim):
+def window_index(n, w):
+    """Return positions along the time axis of all the steps falling in
+    -w/+w window from each timestep.
+
+    Positions depend only on the length of the time axis, so they can be
+    calculated once and used for all the cells.
+
+    Parameters
+    ----------
+    n: int
+        Length of time axis
+    w: int
+        Half width of window
+
+    Returns
+    -------
+    tidx: numpy array
+        Position of the window centre for each step
+    pos: numpy array
+        Position of the step, steps outside the timeseries are dropped
+    """
+    dtype = index_dtype(n + w)
+    tidx = np.repeat(np.arange(n, dtype=dtype), 2 * w + 1)
+    pos = tidx + np.tile(np.arange(-w, w + 1, dtype=dtype), n)
+    inside = (pos >= 0) & (pos < n)
+    return tidx[inside], pos[inside]
+
+
+def window_roll(ts, w, tdim, window_idx=None):
     """Return all values falling in -w/+w window from each day-of-year
     and build new timeseries.
 
@@ -194,6 +282,9 @@ def window_roll(ts, w, tdim):
         Half width of window
     tdim: str
         Name of time dimension
+    window_idx: tuple of numpy arrays, optional
+        Positions returned by window_index(), if None they are
+        calculated from ts
 
     Returns
     -------
@@ -202,79 +293,178 @@ def window_roll(ts, w, tdim):
         a window of width 2*w+1
     """
 
-    width = 2 * w + 1
-    dtime = {tdim: width}
-    trolled = ts.rolling(**dtime, center=True).construct("wdim")
-    troll = trolled.stack(z=("wdim", tdim))
-    twindow = troll.dropna(dim="z")
+    # windows are built as positions along the time axis: positions of
+    # steps which are NaN for all the cells are dropped, so the values
+    # are gathered with one indexing operation, without padding the
+    # array or copying the whole (time, window) array first.
+    # Positions are ordered by (time, window) which gives the 'z'
+    # dimension directly
+    if window_idx is None:
+        window_idx = window_index(ts.sizes[tdim], w)
+    tidx, pos = window_idx
+    valid = ts.notnull()
+    dims = [d for d in ts.dims if d != tdim]
+    if len(dims) > 0:
+        valid = valid.any(dim=dims)
+    keep = np.asarray(valid.values)[pos]
+    tidx, pos = tidx[keep], pos[keep]
+    twindow = ts.isel({tdim: pos}).drop_vars([tdim, "doy"])
+    twindow = twindow.rename({tdim: "z"}).transpose("z", ...)
+    # each value in window is assigned the doy of the window centre
+    twindow.coords["doy"] = ("z", np.asarray(ts["doy"].values)[tidx])
     return twindow
 
 
-@dask.delayed(nout=1)
-def calculate_thresh(twindow, pctile, skipna, tstep):
-    """Calculate threshold for one cell grid at the time
+def group_clim(twindow, q, skipna):
+    """Calculate quantile and mean along 'z' for each day-of-year group.
+
+    Values are reordered by doy, which is the same for all cells, and
+    each doy group is then sorted in place along 'z' for all cells at
+    once, so the quantile is read directly from the sorted block, using
+    the same linear interpolation as numpy/xarray quantile. This
+    replaces calling np.nanquantile separately for each of the doy groups.
+    The mean is calculated from the same sorted block, so the window
+    array is read only once for both climatologies.
 
     Parameters
     ----------
     twindow: xarray DataArray
         Stacked array timeseries with new 'z' dimension representing
         a window of width 2*w+1
-    pctile: int
-        Threshold percentile used to detect events
+    q: float
+        Quantile to calculate, between 0 and 1
     skipna: bool
-        If True percentile and mean function will use skipna=True.
-        Using skipna option is much slower
+        If False any group including a NaN returns NaN
 
     Returns
     -------
-    thresh_climYear: xarray DataArray
-        Climatological threshold
+    quant: xarray DataArray
+        Quantile for each day-of-year
+    mean: xarray DataArray
+        Mean for each day-of-year, with same dtype as twindow
     """
 
-    thresh_climYear = twindow.groupby("doy").quantile(
-        pctile / 100.0, dim="z", skipna=skipna
-    )
-    # calculate value for 29 Feb from mean of 28-29 feb and 1 Mar
-    if tstep is False:
-        thresh_climYear = thresh_climYear.where(
-            thresh_climYear.doy != 60, feb29(thresh_climYear)
-        )
-    thresh_climYear = thresh_climYear.chunk({"doy": -1})
-    return thresh_climYear
-
-
-@dask.delayed(nout=1)
-def calculate_seas(twindow, skipna, tstep):
-    """Calculate mean climatology for one cell grid at the time
+    # move z to the last axis so any other dimension is kept,
+    # values are sorted in their own float dtype so float32 data is not
+    # doubled in size, only the values read back from the sorted
+    # blocks and the sums are in float64
+    dims = [d for d in twindow.dims if d != "z"]
+    values = np.moveaxis(twindow.values, twindow.get_axis_num("z"), -1)
+    if values.dtype.kind != "f":
+        values = values.astype(np.float64)
+    groups = twindow["doy"].values
+    values = values[..., np.argsort(groups, kind="stable")]
+    doys, counts = np.unique(groups, return_counts=True)
+    offsets = np.cumsum(counts) - counts
+    # NaNs are sorted to the end of each doy group
+    for start, count in zip(offsets, counts):
+        values[..., start:start + count].sort(axis=-1)
+    isnan = np.isnan(values)
+    nvalid = np.add.reduceat(~isnan, offsets, axis=-1)
+    # position of quantile in each group, then interpolate linearly
+    # between closest ranks
+    pos = q * (nvalid - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    lo = np.take_along_axis(values, offsets + np.maximum(lo, 0), axis=-1)
+    hi = np.take_along_axis(values, offsets + np.maximum(hi, 0), axis=-1)
+    lo = lo.astype(np.float64)
+    hi = hi.astype(np.float64)
+    quant = lo + (hi - lo) * (pos - np.floor(pos))
+    # sum of valid values in each group, NaNs are not needed anymore
+    values[isnan] = 0.0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.add.reduceat(values, offsets, axis=-1,
+                               dtype=np.float64) / nvalid
+    if skipna:
+        empty = nvalid == 0
+    else:
+        empty = nvalid < counts
+    quant[empty] = np.nan
+    mean[empty] = np.nan
+    coords = {k: v for k, v in twindow.coords.items() if "z" not in v.dims}
+    coords["doy"] = doys
+    mean = xr.DataArray(np.moveaxis(mean, -1, 0).astype(twindow.dtype),
+                        dims=["doy"] + dims, coords=coords)
+    coords["quantile"] = q
+    quant = xr.DataArray(np.moveaxis(quant, -1, 0), dims=["doy"] + dims,
+                         coords=coords)
+    return quant, mean
+
+
+# Delayed functions are pure: keys are tokenized from the arguments, so
+# blocks with the same data and parameters share a task
+@dask.delayed(nout=2, pure=True)
+def calculate_clim(ts, w, tdim, pctile, skipna, tstep,
+                   smoothPercentileWidth=None, window_idx=None):
+    """Calculate threshold and mean climatology for one cell grid or
+    a block of cells
 
     Parameters
     ----------
-    twindow: xarray DataArray
-        Stacked array timeseries with new 'z' dimension representing
-        a window of width 2*w+1
+    ts: xarray DataArray
+        Temperature timeseries array, for one cell or a block of cells
+    w: int
+        Half width of window about day-of-year used for the pooling of
+        values and calculation of threshold percentile
+    tdim: str
+        Name of time dimension
+    pctile: int
+        Threshold percentile used to detect events
     skipna: bool
         If True percentile and mean function will use skipna=True.
         Using skipna option is much slower
+    tstep: bool
+        If True the timeseries timestep is used as base for 'doy' unit
+    smoothPercentileWidth: int, optional
+        Width of moving average window used to smooth both
+        climatologies, if None no smoothing is applied (default is None)
+    window_idx: tuple of numpy arrays, optional
+        Positions returned by window_index(), if None they are
+        calculated from ts
 
     Returns
     -------
+    thresh_climYear: xarray DataArray
+        Climatological threshold
     seas_climYear: xarray DataArray
         Climatological mean
     """
-    seas_climYear = twindow.groupby("doy").mean(dim="z", skipna=skipna)
+
+    # the window array is built inside the task, so a dask ts is read
+    # only when the task runs and the all-NaN steps mask and the doy of
+    # the window centres are calculated from in-memory values
+    twindow = window_roll(ts, w, tdim, window_idx)
+    # for a single cell window_roll drops all NaNs, for a block of cells
+    # NaNs are dropped only if present for all cells, so the remaining
+    # ones are skipped to get the same result as cell by cell
+    if "cell" in twindow.dims:
+        skipna = True
+    thresh_climYear, seas_climYear = group_clim(twindow, pctile / 100.0,
+                                                skipna)
     # calculate value for 29 Feb from mean of 28-29 feb and 1 Mar
     if tstep is False:
+        thresh_climYear = thresh_climYear.where(
+            thresh_climYear.doy != 60, feb29(thresh_climYear)
+        )
         seas_climYear = seas_climYear.where(
             seas_climYear.doy != 60, feb29(seas_climYear)
         )
-    seas_climYear = seas_climYear.chunk({"doy": -1})
-    return seas_climYear
+    # smoothing runs in the same task, as the climatologies are small
+    if smoothPercentileWidth is not None:
+        thresh_climYear = runavg(thresh_climYear, smoothPercentileWidth)
+        seas_climYear = runavg(seas_climYear, smoothPercentileWidth)
+    return thresh_climYear, seas_climYear
 
 
 def join_gaps(st, end, events, maxGap):
     """Find gaps between mhw events which are <= maxGap and join
     events into one event
 
+    mhw_filter() joins events directly on its start and end arrays, so
+    this function is no longer called by the package and it is kept
+    only for compatibility with existing code using it.
+
     Parameters
     ----------
     st: pandas series
@@ -294,28 +484,24 @@ def join_gaps(st, end, events, maxGap):
 
     # remove NaNs
     # build (st,end) pairs
-    # shift end series to align with st series: first value is set to
-    # maxGap+1 so start of first event is always kept
-    # subtract shifted end series form start one to get gaps' lengths
-    # and select as True all gaps > maxGap
-    # use gaps series as selected events start indexes
-    # shift back gaps series, select as True all gaps > maxGap
-    # set last value to True to retain end of last event
-    # use gaps shifted series as selected events end indexes
+    # subtract each event end from the following event start to get
+    # gaps' lengths and select as True all gaps > maxGap, the start
+    # of first event is always kept
+    # use gaps array as selected events start indexes
+    # shift back gaps array, set last value to True to retain end of
+    # last event and use it as selected events end indexes
     # used new and starting pairs to detect events to join
     # reindex so we have a complete time axis
     s = st.dropna()
     e = end.dropna()
     if len(s) > 1:
         pairs = set(zip(s.values, e.values))
-        eshift = e.shift(1)
-        eshift = eshift.fillna(value=-(maxGap + 1))
-        gaps = (s - eshift) > maxGap + 1
-        gaps_shifted = gaps.shift(-1)
-        gaps_shifted = gaps_shifted.fillna(value=True)
-        s = s.where(gaps).dropna()
-        e = e.where(gaps_shifted).dropna()
-        if len(s) < len(st.dropna()):
+        gaps = np.ones(len(s), dtype=bool)
+        gaps[1:] = (s.values[1:] - e.values[:-1]) > maxGap + 1
+        gaps_shifted = np.append(gaps[1:], True)
+        s = s[gaps]
+        e = e[gaps_shifted]
+        if not gaps.all():
             joined = set(zip(s.values, e.values)) - pairs
             events = join_events(events, joined)
         st = s.reindex_like(st)
@@ -326,9 +512,9 @@ def join_gaps(st, end, events, maxGap):
     return joined
 
 
-@dask.delayed(nout=2)
-def define_events(ts, th, se, idxarr, minDuration, joinGaps, maxGap,
-                  intermediate, tdim="time"):
+@dask.delayed(nout=2, pure=True)
+def define_events(ts, th, se, minDuration, joinGaps, maxGap, intermediate,
+                  tdim="time", coldSpells=False):
     """Finds all MHW events of duration >= minDuration and calculate
     their properties.
 
@@ -343,8 +529,6 @@ def define_events(ts, th, se, idxarr, minDuration, joinGaps, maxGap,
         Climatological threshold
     se: pandas Series
         Climatological mean
-    idxarr: pandas Series
-        Index array
     minDuration: int
         Minimum duration (days) to accept of detected MHWs
     joinGaps: bool
@@ -354,6 +538,11 @@ def define_events(ts, th, se, idxarr, minDuration, joinGaps, maxGap,
     intermediate: bool
         If True return also dataset with input data, detected events
         and some events properties along time axis
+    tdim: str, optional
+        Name of time dimension (default='time')
+    coldSpells: bool, optional
+        If True flip ts to detect cold events, th and se should be
+        already flipped (default is False)
 
     Returns
     -------
@@ -363,10 +552,96 @@ def define_events(ts, th, se, idxarr, minDuration, joinGaps, maxGap,
         Dataset with input data, detected events and some events
         properties along time axis. If intermediate is False is None
     """
+    if coldSpells:
+        ts = -1.0 * ts
+    thresh, seas = clim_gather(ts, th, se)
+    return mhw_events(ts, thresh, seas, minDuration, joinGaps, maxGap,
+                      intermediate, tdim)
 
-    # reindex thresh and seas along time index
-    thresh = th.sel(doy=ts.doy)
-    seas = se.sel(doy=ts.doy)
+
+@dask.delayed(nout=2, pure=True)
+def define_events_block(ts, th, se, minDuration, joinGaps, maxGap,
+                        intermediate, tdim="time", coldSpells=False):
+    """Finds all MHW events and calculate their properties for a block
+    of grid cells, so only one task is created for the whole block.
+
+    Parameters are the same as for define_events() but ts, th and se
+    include a 'cell' dimension.
+
+    Returns
+    -------
+    mhw: xarray Dataset
+        Dataset including detected events and their properties, with
+        'cell' dimension
+    mhw_inter: xarray Dataset
+        Intermediate dataset with 'cell' dimension. If intermediate is
+        False is None
+    """
+    if coldSpells:
+        ts = -1.0 * ts
+    # climatologies are reindexed along time once for the whole block
+    thresh, seas = clim_gather(ts, th, se)
+    # results for each cell are concatenated here, so the main process
+    # only has to concatenate one dataset for each block.
+    # Results keep the order of the cells, so the cell coordinates are
+    # assigned once to the concatenated block rather than to each result
+    mhwls = []
+    interls = []
+    for c in range(ts.sizes["cell"]):
+        mhw, mhw_inter = mhw_events(ts.isel(cell=c), thresh.isel(cell=c),
+                                    seas.isel(cell=c), minDuration, joinGaps,
+                                    maxGap, intermediate, tdim)
+        mhwls.append(mhw)
+        if intermediate:
+            interls.append(mhw_inter)
+    coords = {d: ("cell", ts[d].values) for d in ts.cell.coords}
+    mhw = xr.concat(mhwls, dim="cell").assign_coords(coords)
+    mhw_inter = None
+    if intermediate:
+        mhw_inter = xr.concat(interls, dim="cell").assign_coords(coords)
+    return mhw, mhw_inter
+
+
+def clim_gather(ts, th, se):
+    """Reindex threshold and seasonal climatologies along time axis.
+
+    The position of each timestep doy is looked up only once and used
+    for both climatologies, instead of selecting each of them by doy.
+    Raises XmhwException if any doy of ts is missing from climatologies.
+
+    Parameters
+    ----------
+    ts: xarray DataArray
+        Temperature timeseries array with 'doy' coordinate
+    th: xarray DataArray
+        Climatological threshold
+    se: xarray DataArray
+        Climatological mean
+
+    Returns
+    -------
+    thresh: xarray DataArray
+        Climatological threshold along time axis
+    seas: xarray DataArray
+        Climatological mean along time axis
+    """
+    doys = ts["doy"].values
+    idx = th.indexes["doy"].get_indexer(doys)
+    if (idx < 0).any():
+        raise XmhwException(
+            "Climatologies are missing doy values: "
+            + f"{np.unique(doys[idx < 0]).tolist()}"
+        )
+    idx = ts["doy"].copy(data=idx)
+    return th.isel(doy=idx), se.isel(doy=idx)
+
+
+def mhw_events(ts, thresh, seas, minDuration, joinGaps, maxGap,
+               intermediate, tdim="time"):
+    """Detect MHW events for one grid cell, see define_events() for
+    a description of arguments and returned values. thresh and seas
+    are the climatologies already reindexed along time by clim_gather().
+    """
 
     # Find MHWs as exceedances above the threshold
     # Time series of "True" when threshold is exceeded
@@ -390,14 +665,14 @@ def define_events(ts, th, se, idxarr, minDuration, joinGaps, maxGap,
     del ds
 
     # detect events
-    dfev = mhw_filter(df.bthresh, idxarr, minDuration, joinGaps, maxGap)
+    dfev = mhw_filter(df.bthresh, minDuration, joinGaps, maxGap)
 
     # Prepare dataframe to get features before groupby operation
     df = mhw_df(pd.concat([df, dfev], axis=1))
     del dfev
 
     # Calculate mhw properties, for each event using groupby
-    dfmhw = mhw_features(df, len(idxarr) - 1, tdim, dims)
+    dfmhw = mhw_features(df, ts.sizes[tdim] - 1, tdim, dims)
 
     # Convert back to xarray dataset
     mhw = xr.Dataset.from_dataframe(dfmhw, sparse=False)
@@ -413,7 +688,7 @@ def define_events(ts, th, se, idxarr, minDuration, joinGaps, maxGap,
     return mhw, mhw_inter
 
 
-def mhw_filter(bthresh, idxarr, minDuration, joinGaps, maxGap=2):
+def mhw_filter(bthresh, minDuration, joinGaps, maxGap=2):
     """Filter events of consecutive days above threshold which are
     longer then minDuration.
 
@@ -421,8 +696,6 @@ def mhw_filter(bthresh, idxarr, minDuration, joinGaps, maxGap=2):
     ----------
     bthresh: boolean pandas Series
         True values where ts >= threshold for same day-of-year
-    idxarr: pandas Series
-        Index array
     minDuration: int
         Minimum duration (days) to accept detected MHWs
     joinGaps: bool
@@ -435,51 +708,111 @@ def mhw_filter(bthresh, idxarr, minDuration, joinGaps, maxGap=2):
     df: pandas Dataframe
         Includes series for events and their start and end indexes
     """
-    # Build another array where the last index before the start of
-    # a succession of Trues is propagated while False points retain
-    # their positional indexes
-    # events = [0,1,2,3,3,3,3,3,3,9,10,...]
-    events = (idxarr.where(~bthresh).ffill()).fillna(0)
-
-    # by subtracting events from idxarr we get 1/2/3/4 ... counter
-    # for each mhw and 0 elsewhere
-    # events_map = [0,0,0,0,1,2,3,4,5,0,0,...]
-    events_map = idxarr - events
-
-    # subtracting events_map shifted by 1 place to the right from
-    # itself, the last day of the mhw will have a negative value
-    # this is also indicative of the duration of the event.
-    # The series is then shifted back one place to the left and
-    # the boundaries nan are replaced with zeros
-    # shifted = [nan,0,0,0,1,1,1,1,-5,0,0,...]
-    shifted = (events_map - events_map.shift(+1)).shift(-1)
-    shifted = shifted.where(~np.isnan(shifted), -events_map)
-
-    # select only cells where shifted is less equal to the -minDuration,
-    duration = events_map.where(shifted <= -minDuration)
-    # from idxarr select where mhw duration is not NaN,
-    # this will the index of last day of mhw
-    end = idxarr.where(~np.isnan(duration))
-    # removing duration from end index gives starting index
-    st = end - duration + 1
-
-    # add 1 to events so each event is represented by its starting index
-    events = events + 1
-
-    # Selected mhw will be represented by indexes where "events" has
-    # values included in st series and where "events_map" is not 0
-    sel_events = events.where(events.isin(st) & (events_map != 0))
-    sel_events.name = "events"
-
-    # if joinGaps call join_gaps function
-    if joinGaps:
-        df = join_gaps(st, end, sel_events, maxGap)
-    else:
-        df = pd.concat([st.rename("start"), end.rename("end"), sel_events],
-                       axis=1)
+    # Find runs of consecutive days above threshold in a single pass:
+    # padding with False on both sides and differencing the series
+    # gives +1 where a run starts and -1 the day after it ends
+    # exceed = [0,0,0,0,1,1,1,1,1,0,0,...]
+    # edges  = [0,0,0,0,1,0,0,0,0,-1,0,...]
+    exceed = np.zeros(len(bthresh) + 2, dtype=np.int8)
+    exceed[1:-1] = bthresh.values
+    edges = np.diff(exceed)
+    dtype = index_dtype(len(bthresh))
+    starts = np.flatnonzero(edges == 1).astype(dtype)
+    ends = (np.flatnonzero(edges == -1) - 1).astype(dtype)
+
+    # select only runs with duration >= minDuration
+    keep = (ends - starts + 1) >= minDuration
+    starts = starts[keep]
+    ends = ends[keep]
+
+    # start and end indexes are stored at the index of last day of mhw
+    st_pos = ends
+    end_pos = ends
+
+    # if joinGaps join events separated by gaps <= maxGap, as in
+    # join_gaps() but working directly on the start and end arrays:
+    # start of first event and end of last event are always kept,
+    # joined events keep start index at the last day of their first
+    # part and end index at the last day of their last part
+    if joinGaps and len(starts) > 1:
+        gaps = np.ones(len(starts), dtype=bool)
+        gaps[1:] = (starts[1:] - ends[:-1]) > maxGap + 1
+        gaps_shifted = np.append(gaps[1:], True)
+        st_pos = ends[gaps]
+        end_pos = ends[gaps_shifted]
+        starts = starts[gaps]
+        ends = ends[gaps_shifted]
+    # all positions are along bthresh, so its time index is reused,
+    # left unnamed so intermediate results keep 'index' as dimension
+    index = bthresh.index.rename(None)
+    st = pd.Series(np.nan, index=index, name="start")
+    end = pd.Series(np.nan, index=index, name="end")
+    st.iloc[st_pos] = starts
+    end.iloc[end_pos] = ends
+
+    # Selected mhw will be represented by their starting index
+    # for all the days included in the event, including joined gaps
+    lens = ends - starts + 1
+    offsets = starts - np.cumsum(lens, dtype=dtype) + lens
+    days = np.arange(lens.sum(), dtype=dtype) + np.repeat(offsets, lens)
+    sel_events = pd.Series(np.nan, index=index, name="events")
+    sel_events.iloc[days] = np.repeat(starts, lens)
+
+    df = pd.concat([st, end, sel_events], axis=1)
     return df
 
 
+def index_dtype(n):
+    """Return smallest integer dtype which can hold positions up to n.
+
+    Timeseries are usually shorter than 32767 or 2147483647 steps, so
+    positional indexes can be stored in int16 or int32 arrays instead
+    of the default int64, which reduces memory use.
+
+    Parameters
+    ----------
+    n: int
+        Length of the indexed array
+
+    Returns
+    -------
+    dtype: numpy dtype
+        Integer dtype for positional indexes
+    """
+    for dtype in (np.int16, np.int32):
+        if n <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def cell_chunks(ts, tdim="time", target_bytes=128 * 1024 * 1024):
+    """Return number of grid cells to process together in one task.
+
+    Blocks are limited so each one holds about target_bytes of data,
+    but the cells are still split so there are a few blocks for each
+    available cpu.
+
+    Parameters
+    ----------
+    ts: xarray DataArray
+        Timeseries array stacked on 'cell' dimension
+    tdim: str, optional
+        Name of time dimension (default='time')
+    target_bytes: int, optional
+        Approximate size of data in each block (default is 128MB)
+
+    Returns
+    -------
+    size: int
+        Number of cells in each block
+    """
+    ncells = ts.sizes["cell"]
+    size = target_bytes // (ts.sizes[tdim] * ts.dtype.itemsize)
+    nblocks = 4 * dask.system.CPU_COUNT
+    size = min(size, -(-ncells // nblocks))
+    return max(1, int(size))
+
+
 def land_check(temp, tdim="time", anynans=False):
     """Return new array with all dimensions but time stacked and
     land points removed.
@@ -520,20 +853,99 @@ def land_check(temp, tdim="time", anynans=False):
     # adding sorted to be consistent if applying functipn to different arrays with same dimensions
     ts = temp.stack(cell=(sorted(dims)), create_index=False)
     # drop cells that have all/any nan values along time
-    how = "all"
+    # counting valid values is a single reduction along time, the
+    # resulting mask is small and can be used directly to index cells
+    nvalid = ts.count(dim=tdim)
+    if isinstance(nvalid, xr.Dataset):
+        nvalid = nvalid.to_array()
+    other = [d for d in nvalid.dims if d != "cell"]
     if anynans:
-        how = "any"
-    ts = ts.dropna(dim="cell", how=how)
+        keep = (nvalid == ts.sizes[tdim]).all(dim=other)
+    else:
+        keep = (nvalid > 0).any(dim=other)
+    ts = ts.isel(cell=np.flatnonzero(keep.values))
     # if ts.cell.shape is 0 then all points are land, quit
     if ts.cell.shape == (0,):
         raise XmhwException("All points of grid are either land or NaN")
     return ts
 
 
+def unstack_cells(ds, dims):
+    """Return dataset with 'cell' dimension unstacked back on the
+    original dimensions, reverse of the stacking done in land_check.
+
+    Each variable is scattered into a NaN filled array using the flat
+    position of each cell on the grid, so no MultiIndex is created, as
+    when calling set_xindex() and unstack(). As for unstack() the grid
+    includes only the dimension values found in the stacked cells.
+
+    Parameters
+    ----------
+    ds: xarray Dataset
+        Dataset with 'cell' dimension
+    dims: list(str)
+        Names of 'cell' coordinates to use as new dimensions
+
+    Returns
+    -------
+    ds: xarray Dataset
+        Dataset with dims replacing 'cell' as last dimensions
+    """
+
+    # grid values and position of each cell along the new dimensions
+    levels = []
+    codes = []
+    for d in dims:
+        level, code = np.unique(ds[d].values, return_inverse=True)
+        levels.append(level)
+        codes.append(code)
+    shape = tuple(len(level) for level in levels)
+    flat = np.ravel_multi_index(codes, shape)
+    missing = len(flat) < np.prod(shape)
+    coords = {d: (d, level, ds[d].attrs) for d, level in zip(dims, levels)}
+    out = xr.Dataset(coords=coords, attrs=ds.attrs)
+    for name, var in ds.variables.items():
+        if name in dims:
+            continue
+        if "cell" not in var.dims:
+            out[name] = var
+            continue
+        var = var.transpose(..., "cell")
+        size = var.shape[:-1] + (np.prod(shape),)
+        # fill grid points without a cell with NaN/NaT, promoting dtypes
+        # only if needed and as unstack() does: integers to float,
+        # booleans and objects (i.e. cftime dates) to object
+        if not missing:
+            data = np.empty(size, dtype=var.dtype)
+        elif var.dtype.kind in "mM":
+            data = np.full(size, "NaT", dtype=var.dtype)
+        elif var.dtype.kind in "fc":
+            data = np.full(size, np.nan, dtype=var.dtype)
+        elif var.dtype.kind in "Ob":
+            data = np.full(size, np.nan, dtype=object)
+        else:
+            data = np.full(size, np.nan)
+        data[..., flat] = var.values
+        out[name] = (var.dims[:-1] + tuple(dims),
+                     data.reshape(var.shape[:-1] + shape), var.attrs)
+    out = out.set_coords([c for c in ds.coords if c in out])
+    return out
+
+
 def join_events(events, joined):
-    """Update 'event' series values for joined events"""
-    for s, e in joined:
-        events.iloc[int(s):int(e) + 1] = s
+    """Update 'event' series values for joined events.
+
+    Used only by join_gaps(), kept for compatibility with existing code.
+    """
+    # all (start, end) ranges are assigned in one step: positions are
+    # built as for mhw_filter days and set to the start of their range
+    if len(joined) == 0:
+        return events
+    ss, ees = np.array(sorted(joined), dtype=np.int64).T
+    lens = ees - ss + 1
+    days = np.arange(lens.sum()) + np.repeat(ss - np.cumsum(lens) + lens,
+                                             lens)
+    events.iloc[days] = np.repeat(ss, lens)
     return events
 
 
@@ -665,11 +1077,16 @@ def annotate_ds(ds, ds_attrs, kind):
             "long_name"
         ] = "MHW cumulative intensity absolute magnitude"
         ds.intensity_cumulative_abs.attrs["units"] = f"{uts} day"
-        # should be treated as flags from CF point of view?
+        # category is stored as integer codes, their meaning is
+        # described using CF flag attributes
         ds.category.attrs["long_name"] = (
             "MHW category based on peak "
             + "intensity: 1: Moderate, 2: Strong, 3: Severe or 4: Extreme"
         )
+        # CF requires flag_values to have the same type as the variable
+        ds.category.attrs["flag_values"] = np.array(
+            [1, 2, 3, 4], dtype=ds.category.dtype)
+        ds.category.attrs["flag_meanings"] = "moderate strong severe extreme"
         ds.duration_moderate.attrs[
             "long_name"
         ] = "Number of days falling in category Moderate"
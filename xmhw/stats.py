@@ -20,7 +20,7 @@ import xarray as xr
 import numpy as np
 import pandas as pd
 import dask
-from xmhw.identify import land_check
+from xmhw.identify import land_check, unstack_cells
 from .exception import XmhwException
 
 
@@ -89,6 +89,11 @@ def block_average(
     # and the mhw 'cell' coordinate should be renamed to be consistent
     sw_temp = False
     sw_cats = False
+    # mhw from a single point has only the 'events' dimension
+    if len(mhw[mtime].dims) == 1:
+        stack_coord = "point"
+    else:
+        stack_coord = "cell"
     # currently I'm try to accept any name for temperature as long as it
     # is passed on its own and only temp thresh seas if they are all
     # passed as a dataset. Might make more sense to deal with this
@@ -98,8 +103,6 @@ def block_average(
     if dstime is not None:
         dstime, sw_cats, sw_temp = check_variables(dstime)
         dstime, stack_coord = check_coordinates(dstime)
-        if stack_coord is None:
-            point = True
         period = [
             dstime.time.dt.year[0].values,
             dstime.time.dt.year[-1].values,
@@ -130,22 +133,17 @@ def block_average(
     # for last year/s included
     bins = range(period[0], period[1] + blockLength + 1, blockLength)
 
-    # calculate with aggregation function
-    blockls = []
-    # this defines years array to use to groupby arrays
-    tgroup = mhw[mtime].dt.year
-    if stack_coord == 'point':
-        blockls.append(call_groupby(mhw, tgroup, bins))
-    else:
+    # calculate with aggregation function, all cells are grouped at
+    # once by cell and block, rather than calling groupby cell by cell
+    if stack_coord != "point":
         # remove land and stack on cell
+        dims = [d for d in mhw[mtime].dims if d != "events"]
         mhw = land_check(mhw, tdim="events")
-        for c in mhw.cell:
-            blockls.append(call_groupby(mhw.sel(cell=c), tgroup, bins))
-    results = dask.compute(blockls)
-    if stack_coord == 'point':
-        block = blockls[0]
-    else:
-        block = xr.concat(results[0], dim=mhw.cell).unstack("cell")
+    # this defines years array to use to groupby arrays
+    tgroup = mhw[mtime].dt.year
+    block = dask.compute(call_groupby(mhw, tgroup, bins))[0]
+    if stack_coord != "point":
+        block = cell_coords(block, mhw, dims)
 
     # if we have ts and/or climatologies we add more stats along time axis
     if sw_temp:
@@ -157,26 +155,11 @@ def block_average(
             mode = "cats"
         else:
             mode = "ts"
-        #tgroup = dstime.isel({stack_coord: 0}).time.dt.year
         tgroup = dstime.time.dt.year
-        statsls = []
-        if stack_coord == 'point':
-            statsls.append( call_groupby(
-                    dstime.sel({stack_coord: c}), tgroup, bins, mode=mode)
-                )
-        else:
-            for c in dstime[stack_coord]:
-                cell_stats = call_groupby(
-                    dstime.sel({stack_coord: c}), tgroup, bins, mode=mode
-                )
-                statsls.append(cell_stats)
-        results = dask.compute(statsls)
-        if stack_coord == 'point':
-            tstast = results[0][0]
-        else:
-            tstats = xr.concat(results[0], dim=dstime[stack_coord])
-        if stack_coord == "cell":
-            tstats = tstats.unstack(stack_coord)
+        tstats = dask.compute(
+            call_groupby(dstime, tgroup, bins, mode=mode))[0]
+        if stack_coord != "point":
+            tstats = cell_coords(tstats, dstime, dims)
         block = xr.merge([block, tstats])
 
     return block
@@ -282,13 +265,17 @@ def check_coordinates(dstime):
 
 @dask.delayed
 def call_groupby(ds, tgroup, bins, mode="mhw"):
-    """Call groupby on mhw results cell by cell using the specified
-    aggregation dictionary.
+    """Call groupby on mhw results using the specified aggregation
+    dictionary.
+
+    If ds has a 'cell' dimension all cells are aggregated at once,
+    grouping rows by cell and block, and the results have 'cell' and
+    'years' dimensions.
 
     Parameters
     ----------
     ds: xarray Dataset
-        mhw dataset for 1 grid point
+        mhw dataset for 1 grid point or stacked on 'cell'
     tgroup: xarray DataArray
         Years of mhw time variable to use to assign events to blocks
     bins: list(int)
@@ -299,9 +286,16 @@ def call_groupby(ds, tgroup, bins, mode="mhw"):
 
     # convert mhw Dataset to Dataframe
     df = ds.to_dataframe()
+    # years and cell of each row, in the same order as the dataframe
+    cells = None
+    if "cell" in ds.dims:
+        dims = list(df.index.names)
+        tgroup = tgroup.broadcast_like(ds[dims]).transpose(*dims)
+        tgroup = tgroup.values.ravel()
+        cells = df.index.get_level_values("cell")
     # groupby mtime and aggregate variables
     fagg = "agg_" + mode
-    dfblock = globals()[fagg](df, tgroup, bins)
+    dfblock = globals()[fagg](df, tgroup, bins, cells)
     # add total number of actual MHW days per block
     if fagg == "agg_cats":
         dfblock["total_days"] = (
@@ -311,14 +305,21 @@ def call_groupby(ds, tgroup, bins, mode="mhw"):
             + dfblock["extreme_days"]
         )
     # convert Catgorical index to normal index
-    dfblock.index = dfblock.index.to_list()
-    dfblock.index.name = "years"
+    if cells is None:
+        dfblock.index = dfblock.index.to_list()
+        dfblock.index.name = "years"
+    else:
+        dfblock.index = pd.MultiIndex.from_arrays(
+            [dfblock.index.get_level_values(0),
+             dfblock.index.get_level_values(1).to_list()],
+            names=["cell", "years"],
+        )
     # convert back to xarray dataset
     block = xr.Dataset.from_dataframe(dfblock, sparse=False)
     return block
 
 
-def agg_mhw(df, tgroup, bins):
+def agg_mhw(df, tgroup, bins, cells=None):
     """Apply groupby on mhw properties dataframe after defining an
     aggregation dictionary.
 
@@ -330,6 +331,9 @@ def agg_mhw(df, tgroup, bins):
         Years of mhw time variable to use to assign events to blocks
     bins: list(int)
         Intervals to use to define blocks
+    cells: pandas Index, optional
+        Cell of each row, if passed rows are grouped by cell and block
+        (default is None)
 
     Returns
     -------
@@ -339,7 +343,9 @@ def agg_mhw(df, tgroup, bins):
 
     # first use pandas.cut to separate datFrame in bins
     dfbins = pd.cut(tgroup, bins, right=False)
-    dfgroup = df.groupby(dfbins).agg(
+    if cells is not None:
+        dfbins = [cells, dfbins]
+    dfgroup = df.groupby(dfbins, observed=False).agg(
         ecount=("event", "count"),
         duration=("duration", "mean"),
         intensity_max=("intensity_max", "mean"),
@@ -367,7 +373,7 @@ def cat_days(series, cat=1):
     return series[series == cat].count()
 
 
-def agg_cats(df, tgroup, bins):
+def agg_cats(df, tgroup, bins, cells=None):
     """Apply groupby on timeseries and categories dataframe after
     defining an aggregation dictionary.
 
@@ -379,6 +385,9 @@ def agg_cats(df, tgroup, bins):
         Years of mhw time variable to use to assign events to blocks
     bins: list(int)
         Intervals to use to define blocks
+    cells: pandas Index, optional
+        Cell of each row, if passed rows are grouped by cell and block
+        (default is None)
 
     Returns
     -------
@@ -388,19 +397,24 @@ def agg_cats(df, tgroup, bins):
 
     # first use pandas.cut to separate dataFrame in bins
     dfbins = pd.cut(tgroup, bins, right=False)
-    dfgroup = df.groupby(dfbins).agg(
+    if cells is not None:
+        dfbins = [cells, dfbins]
+    dfgroup = df.groupby(dfbins, observed=False).agg(
         ts_mean=("ts", "mean"),
         ts_max=("ts", "max"),
         ts_min=("ts", "min"),
-        moderate_days=("cats", lambda x: cat_days(x, 1)),
-        strong_days=("cats", lambda x: cat_days(x, 2)),
-        severe_days=("cats", lambda x: cat_days(x, 3)),
-        extreme_days=("cats", lambda x: cat_days(x, 4)),
     )
+    # count days in each category for all blocks with one sum, rather
+    # than calling cat_days for each block and category
+    names = ["moderate_days", "strong_days", "severe_days", "extreme_days"]
+    cats = pd.DataFrame(
+        {name: df["cats"] == (c + 1) for c, name in enumerate(names)})
+    dfcats = cats.groupby(dfbins, observed=False).sum()
+    dfgroup[names] = dfcats[names]
     return dfgroup
 
 
-def agg_ts(df, tgroup, bins):
+def agg_ts(df, tgroup, bins, cells=None):
     """Apply groupby on ts dataframe after defining an aggregation
     dictionary.
 
@@ -412,6 +426,9 @@ def agg_ts(df, tgroup, bins):
         Years of mhw time variable to use to assign events to blocks
     bins: list(int)
         Intervals to use to define blocks
+    cells: pandas Index, optional
+        Cell of each row, if passed rows are grouped by cell and block
+        (default is None)
 
     Returns
     -------
@@ -421,12 +438,38 @@ def agg_ts(df, tgroup, bins):
 
     # first use pandas.cut to separate datFrame in bins
     dfbins = pd.cut(tgroup, bins, right=False)
-    dfgroup = df.groupby(dfbins).agg(
+    if cells is not None:
+        dfbins = [cells, dfbins]
+    dfgroup = df.groupby(dfbins, observed=False).agg(
         ts_mean=("ts", "mean"), ts_max=("ts", "max"), ts_min=("ts", "min")
     )
     return dfgroup
 
 
+def cell_coords(block, ds, dims):
+    """Assign grid coordinates to statistics calculated on 'cell' and
+    unstack them back on the original dimensions.
+
+    Parameters
+    ----------
+    block: xarray Dataset
+        Statistics with 'cell' dimension, as returned by call_groupby()
+    ds: xarray Dataset
+        Dataset stacked on 'cell' used to calculate the statistics
+    dims: list(str)
+        Names of 'cell' coordinates to use as new dimensions
+
+    Returns
+    -------
+    block: xarray Dataset
+        Statistics with dims replacing 'cell'
+    """
+    cells = block["cell"].values
+    block = block.drop_vars("cell").assign_coords(
+        {d: ("cell", ds[d].values[cells], ds[d].attrs) for d in dims})
+    return unstack_cells(block, dims)
+
+
 def find_across(mhw):
     """Find all events that span across a year."""
     mhw_span = mhw.where(
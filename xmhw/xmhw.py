@@ -18,17 +18,17 @@
 
 import xarray as xr
 import numpy as np
-import pandas as pd
 import dask
 from .identify import (
     land_check,
+    unstack_cells,
     add_doy,
     get_calendar,
     define_events,
-    runavg,
-    window_roll,
-    calculate_thresh,
-    calculate_seas,
+    define_events_block,
+    cell_chunks,
+    window_index,
+    calculate_clim,
     annotate_ds,
 )
 from .features import flip_cold
@@ -54,7 +54,9 @@ def threshold(
     Parameters
     ----------
     temp: xarray DataArray
-        Temperature timeseries array
+        Temperature timeseries array. If it is a dask array it is
+        rechunked to have the whole time axis in each chunk, so it is
+        better not to chunk it along time
     tdim: str, optional
         Name of time dimension (default 'time')
     climatologyPeriod: list(int), optional
@@ -120,6 +122,7 @@ def threshold(
     # Check if there is only one dimension (assumed as time)
     # then skip all multidimensional operations
     dims = list(temp.dims)
+    point = False
     if len(dims) == 1:
         point = True
     # Save original attributes in dictionary to assign to final dataset
@@ -147,9 +150,13 @@ def threshold(
     #        + "NB We treat all these calendars in the same way in the "
     #        + "assumption that the timeseries starts after 1582")
 
-    # Flip ts time series if detecting cold spells
+    # If detecting cold spells, the climatologies of the flipped ts are
+    # the flipped climatologies of ts for the complementary percentile,
+    # so these are calculated and flipped instead of all the ts values
     if coldSpells:
-        ts = -1.0 * ts
+        cpctile = 100 - pctile
+    else:
+        cpctile = pctile
 
     # Linear interpolation of all consecutive missing blocks
     # of length <= maxPadLength
@@ -157,6 +164,10 @@ def threshold(
     if maxPadLength:
         ts = ts.interpolate_na(dim=tdim, max_gap=maxPadLength)
 
+    # positions of the steps in the window of each timestep depend only
+    # on the time axis, so they are calculated once for all cells
+    window_idx = window_index(ts.sizes[tdim], windowHalfWidth)
+
     # Open list for partial results and dataset to save calculated results
     climls = []
     ds = xr.Dataset()
@@ -167,49 +178,75 @@ def threshold(
             calc_clim(
                 ts,
                 tdim,
-                pctile,
+                cpctile,
                 windowHalfWidth,
                 smoothPercentile,
                 smoothPercentileWidth,
                 tstep,
                 skipna,
+                window_idx,
                 )
             )
 
     else:
-    # Loop over each cell to calculate climatologies, main functions
-    # are delayed, so loop is automatically run in parallel
-        for c in ts.cell:
+    # Loop over blocks of cells, climatologies are calculated for all
+    # cells in a block at once and main functions are delayed, so loop
+    # is automatically run in parallel. The window array holds 2w+1
+    # copies of each value so blocks are smaller than for detect
+        width = 2 * windowHalfWidth + 1
+        size = cell_chunks(ts, tdim, target_bytes=128 * 1024 * 1024 // width)
+        # if ts is a dask array make each block a single chunk with the
+        # whole time axis, so blocks don't read several time chunks
+        if ts.chunks:
+            ts = ts.chunk({tdim: -1, "cell": size})
+        for i in range(0, ts.sizes["cell"], size):
             climls.append(
                 calc_clim(
-                    ts.sel(cell=c),
+                    ts.isel(cell=slice(i, i + size)),
                     tdim,
-                    pctile,
+                    cpctile,
                     windowHalfWidth,
                     smoothPercentile,
                     smoothPercentileWidth,
                     tstep,
                     skipna,
+                    window_idx,
                 )
             )
     results = dask.compute(climls)
 
-    #thresh_results = [r[0] for r in results[0]]
-    # apply temporary fix suggested by @bjnmr issue #49
-    # as newver version of xarray are removing coords when calculating quantile but not for mean
-    # as I removed the multiindex I'm passing directly r[1].coords and not r[1]['cell'].coords 
-    # this causes issues when trying to concatenate
-    thresh_results = [r[0].assign_coords(r[1].coords) for r in results[0]]
+    thresh_results = [r[0] for r in results[0]]
     seas_results = [r[1] for r in results[0]]
     if point:
         ds["thresh"] = thresh_results[0]
         ds["seas"] = seas_results[0]
     else:
-        ds["thresh"] = xr.concat(thresh_results, dim='cell')
-        ds["seas"] = xr.concat(seas_results, dim='cell')
+        # blocks are in cell order and have the same doy axis, so their
+        # values are joined in one preallocated array for each variable
+        # rather than concatenating DataArrays
         dims = [k for k in ts.cell.coords.keys()]
-        ds = ds.set_xindex(dims)
-        ds = ds.unstack(dim='cell')
+        coords = {k: v for k, v in thresh_results[0].coords.items()
+                  if "cell" not in v.dims}
+        coords.update({k: ("cell", ts[k].values) for k in dims})
+        for name, blocks in [("thresh", thresh_results),
+                             ("seas", seas_results)]:
+            axis = blocks[0].get_axis_num("cell")
+            shape = list(blocks[0].shape)
+            shape[axis] = ts.sizes["cell"]
+            data = np.empty(shape, dtype=blocks[0].dtype)
+            i = 0
+            for block in blocks:
+                idx = [slice(None)] * len(shape)
+                idx[axis] = slice(i, i + block.sizes["cell"])
+                data[tuple(idx)] = block.values
+                i += block.sizes["cell"]
+            ds[name] = xr.DataArray(data, dims=blocks[0].dims,
+                                    coords=coords)
+        ds = unstack_cells(ds, dims)
+    if coldSpells:
+        ds["thresh"] = -ds["thresh"]
+        ds["seas"] = -ds["seas"]
+        ds = ds.assign_coords(quantile=pctile / 100.0)
     ds.thresh.name = "threshold"
     ds.seas.name = "seasonal"
 
@@ -217,30 +254,21 @@ def threshold(
     ds = annotate_ds(ds, ds_attrs, "clim")
     # add all parameters used to global attributes
     dum = [ts[tdim][0].dt.year.values, ts[tdim][-1].dt.year.values]
-    params = f"""Threshold calculated using:
-    {pctile} percentile;
-    climatology period is {dum[0]}-{dum[1]}';
-    window half width used for percentile is {windowHalfWidth}"""
+    params = [
+        f"{pctile} percentile",
+        f"climatology period is {dum[0]}-{dum[1]}",
+        f"window half width used for percentile is {windowHalfWidth}",
+    ]
     if skipna:
-        params = (
-            params
-            + """;
-            NaNs where skipped in percentile and mean calculations"""
-        )
+        params.append("NaNs where skipped in percentile and mean "
+                      + "calculations")
     if smoothPercentile:
-        params = (
-            params
-            + f""";
-         width of moving average window to smooth percentile is
-         {smoothPercentileWidth}"""
-        )
+        params.append("width of moving average window to smooth "
+                      + f"percentile is {smoothPercentileWidth}")
     if anynans:
-        params = (
-            params
-            + """;
-            any grid point with even only 1 NaN along time
-            axis has been removed from calculation"""
-        )
+        params.append("any grid point with even only 1 NaN along time "
+                      + "axis has been removed from calculation")
+    params = "Threshold calculated using:\n    " + ";\n    ".join(params)
     ds.attrs["xmhw_parameters"] = params
     return ds
 
@@ -254,6 +282,7 @@ def calc_clim(
     smoothPercentileWidth,
     tstep,
     skipna,
+    window_idx=None,
 ):
     """Calculate climatologies.
 
@@ -280,6 +309,9 @@ def calc_clim(
     skipna: bool
         If True percentile and mean function will use skipna=True.
         Using skipna option is much slower
+    window_idx: tuple of numpy arrays, optional
+        Positions of each timestep and of the steps in its window, as
+        returned by window_index(). If None they are calculated here
 
     Returns
     -------
@@ -289,18 +321,15 @@ def calc_clim(
         Climatological mean for the grid cell
     """
 
-    twindow = window_roll(ts, windowHalfWidth, tdim)
-    # Rechunk twindow so all timeseries is in 1 chunk
-    twindow = twindow.chunk({"z": -1})
-
     # Calculate threshold and seasonal climatology across years
-    thresh_climYear = calculate_thresh(twindow, pctile, skipna, tstep)
-    seas_climYear = calculate_seas(twindow, skipna, tstep)
-
-    # If smooth option on smooth both climatologies
-    if smoothPercentile:
-        thresh_climYear = runavg(thresh_climYear, smoothPercentileWidth)
-        seas_climYear = runavg(seas_climYear, smoothPercentileWidth)
+    # and, if smooth option on, smooth both climatologies.
+    # The window array is built inside the delayed calculate_clim(),
+    # where the quantile and mean are calculated with one sort along
+    # 'z', so nothing is computed while the graph is built
+    width = smoothPercentileWidth if smoothPercentile else None
+    thresh_climYear, seas_climYear = calculate_clim(
+        ts, windowHalfWidth, tdim, pctile, skipna, tstep, width, window_idx
+    )
 
     return thresh_climYear, seas_climYear
 
@@ -325,11 +354,15 @@ def detect(
     Parameters
     ----------
     temp: xarray DataArray
-        Temperature timeseries array
+        Temperature timeseries array. If it is a dask array it is
+        rechunked to have the whole time axis in each chunk, so it is
+        better not to chunk it along time
     th: xarray DataArray
-        Climatological threshold (e.g., 90th percentile)
+        Climatological threshold (e.g., 90th percentile). If it is a
+        dask array it is persisted once, before events are detected
     se: xarray DataArray
-        Climatological mean
+        Climatological mean. If it is a dask array it is persisted
+        once, before events are detected
     tdim: str, optional
         Name of time dimension (default='time')
     minDuration: int, optional
@@ -376,6 +409,7 @@ def detect(
     # Check if there is only one dimension (assumed as time)
     # then skip all multidimensional operations
     dims = list(temp.dims)
+    point = False
     if len(dims) == 1:
         point = True
     # if time dimension different from time, rename it
@@ -396,6 +430,10 @@ def detect(
         del temp
         th = land_check(th, tdim="doy", anynans=anynans)
         se = land_check(se, tdim="doy", anynans=anynans)
+    # climatologies are small compared to temp, if they are lazy they are
+    # calculated once here, rather than as part of each block task
+    if th.chunks or se.chunks:
+        th, se = dask.persist(th, se)
     # assign doy
     ts = add_doy(ts, tdim=tdim, keep_tstep=tstep)
 
@@ -404,13 +442,8 @@ def detect(
     # NB by default maxPadLength is None and there is no interpolation
     if maxPadLength:
         ts = ts.interpolate_na(dim=tdim, max_gap=maxPadLength)
-    # Flip temp time series if detecting cold spells
-    if coldSpells:
-        ts = -1.0 * ts
-
-    # Build a pandas series with the positional indexes as values
-    # [0,1,2,3,4,5,6,7,8,9,10,..]
-    idxarr = pd.Series(data=np.arange(len(ts[tdim])), index=ts[tdim].values)
+    # If detecting cold spells, temp time series is flipped inside each
+    # task, so a flipped copy of the whole timeseries is not created
 
     # Open list for partial results
     mhwls = []
@@ -422,29 +455,40 @@ def detect(
                 ts,
                 th,
                 se,
-                idxarr,
                 minDuration,
                 joinGaps,
                 maxGap,
                 intermediate,
                 tdim,
+                coldSpells,
             )
         )
     else:
-        # Loop over each cell to detect MHW events, define_events()
-        # is delayed, so loop is automatically run in parallel
-        for c in ts.cell:
+        # Loop over blocks of cells to detect MHW events,
+        # define_events_block() is delayed, so loop is automatically
+        # run in parallel with one task for each block
+        size = cell_chunks(ts, tdim)
+        # if arrays are dask arrays make each block a single chunk with
+        # the whole time (or doy) axis
+        if ts.chunks:
+            ts = ts.chunk({tdim: -1, "cell": size})
+        if th.chunks:
+            th = th.chunk({"doy": -1, "cell": size})
+        if se.chunks:
+            se = se.chunk({"doy": -1, "cell": size})
+        for i in range(0, ts.sizes["cell"], size):
+            block = {"cell": slice(i, i + size)}
             mhwls.append(
-                define_events(
-                    ts.sel(cell=c),
-                    th.sel(cell=c),
-                    se.sel(cell=c),
-                    idxarr,
+                define_events_block(
+                    ts.isel(block),
+                    th.isel(block),
+                    se.isel(block),
                     minDuration,
                     joinGaps,
                     maxGap,
                     intermediate,
                     tdim,
+                    coldSpells,
                 )
             )
     results = dask.compute(mhwls)
@@ -459,17 +503,14 @@ def detect(
             mhw_inter = inter_results[0]
     else:
         dims = list(ts.cell.coords)
-        mhw_results = [r[0].assign_coords({d: r[0][d][0].values for d in dims})
-                       for r in results[0]]
+        # each block result is already concatenated along cell
+        mhw_results = [r[0] for r in results[0]]
         mhw = xr.concat(mhw_results, dim='cell')
-        mhw = mhw.set_xindex(dims)
-        mhw = mhw.unstack(dim='cell')
+        mhw = unstack_cells(mhw, dims)
         if intermediate:
-            inter_results = [r[1].assign_coords({d: r[1][d][0].values for d in dims})
-                             for r in results[0]]
+            inter_results = [r[1] for r in results[0]]
             mhw_inter = xr.concat(inter_results, dim='cell')
-            mhw_inter = mhw_inter.set_xindex(dims)
-            mhw_inter = mhw_inter.unstack('cell')
+            mhw_inter = unstack_cells(mhw_inter, dims)
             mhw_inter = mhw_inter.rename({'index': 'time'})
             mhw_inter = mhw_inter.squeeze(drop=True)
 
@@ -480,34 +521,20 @@ def detect(
     # add previously saved attributes to ds
     mhw = annotate_ds(mhw, ds_attrs, "mhw")
     # add all parameters used to global attributes
-    params = f"MHW detected using: {minDuration} days of minimum duration"
+    params = [f"{minDuration} days of minimum duration"]
     if joinGaps:
-        params = (
-            params
-            + f""";
-            events separated by {maxGap} or less days were joined"""
-        )
+        params.append(f"events separated by {maxGap} or less days were "
+                      + "joined")
     if coldSpells:
-        params = (
-            params
-            + """;
-                cold events were detected instead of heat events"""
-        )
+        params.append("cold events were detected instead of heat events")
     if maxPadLength:
-        params = (
-            params
-            + f""";
-            where original timeseries had missing values interpolation
-            was used to fill them. Gaps > {maxPadLength} days long were
-            left as NaNs;"""
-        )
+        params.append("where original timeseries had missing values "
+                      + "interpolation was used to fill them. Gaps > "
+                      + f"{maxPadLength} days long were left as NaNs")
     if anynans:
-        params = (
-            params
-            + """;
-            any grid point with even only 1 NaN along time
-            axis has been removed from calculation"""
-        )
+        params.append("any grid point with even only 1 NaN along time "
+                      + "axis has been removed from calculation")
+    params = "MHW detected using: " + "; ".join(params)
     mhw.attrs["xmhw_parameters"] = params
     if intermediate:
         return mhw, mhw_inter